@@ -7,4 +7,4 @@ import sys
 
 # Call analytics method
 if __name__ == "__main__":
-    launch(sys.argv)
+    sys.exit(launch(sys.argv))
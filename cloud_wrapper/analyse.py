@@ -3,6 +3,7 @@ Primary wrapper analysis code
 """
 import json
 import importlib
+import hashlib
 from jsonmerge import merge
 import os
 from linetimer import CodeTimer
@@ -12,6 +13,133 @@ if __package__ == '':
 else:
     from . import storage
 
+"""
+Filter stages by filter module name, so filters are created once and keep their state between samples
+"""
+_filters = {}
+
+_WHITESPACE = ' \n\r\t'
+_DIGEST_CHUNK = 1024 * 1024
+
+class _FilterStage:
+    """
+    Wraps a filter module. A module can provide a plain function
+
+        def filter(config, device_data) -> dict
+
+    or a class, created once with the configuration of the first sample and kept for all later samples
+
+        class Filter:
+            incremental = False
+            def __init__(self, config)
+            def filter(self, device, device_data) -> dict
+
+    An incremental filter (incremental = True) receives only the records appended to
+    each collection partition since its previous call for that device
+
+            def filter(self, device, device_data, reset) -> dict
+
+    where reset is the set of partitions passed in full, i.e. on the first call for a device,
+    when a collection was changed other than by appending to it, or when a partition is not a collection.
+
+    A collection is a partition holding a JSON array, compact or indented, such as those kept by
+    AppendingFileDataStore and AppendingS3DataStore. Appends are recognised by the length and digest
+    of the previous content, so only stores that append records after the existing ones are sliced.
+    """
+    def __init__(self, module, config):
+        self.module = module
+        if hasattr(module, 'Filter'):
+            self.instance = module.Filter(config)
+            self.incremental = getattr(self.instance, 'incremental', False)
+        else:
+            self.instance = None
+            self.incremental = False
+        self.marks = {}
+
+    def apply(self, config, device, device_data):
+        if self.instance is None:
+            return self.module.filter(config, device_data)
+        if not self.incremental:
+            return self.instance.filter(device, device_data)
+
+        new_data = {}
+        marks = {}
+        reset = set()
+        for partition, value in device_data.items():
+            new_data[partition], marks[(device, partition)] = self._new_records(device, partition, value)
+            if new_data[partition] is value:
+                reset.add(partition)
+        result = self.instance.filter(device, new_data, reset)
+
+        # Records only count as seen once the filter has processed them
+        for key, mark in marks.items():
+            if mark is None:
+                self.marks.pop(key, None)
+            else:
+                self.marks[key] = mark
+        return result
+
+    def _new_records(self, device, partition, value):
+        """
+        Cut the records appended since the last call out of a collection partition.
+        Returns the records (or the full value) and the mark to remember for the next call.
+        The previous content is checked with a digest rather than parsed, which still
+        reads it once per call.
+        """
+        if not isinstance(value, str):
+            return value, None
+        first = _skip_whitespace(value, 0, 1)
+        last = _skip_whitespace(value, len(value) - 1, -1)
+        if first > last or value[first] != '[' or value[last] != ']':
+            return value, None
+
+        # End of the content before the closing bracket, ignoring whitespace
+        end = _skip_whitespace(value, last - 1, -1) + 1
+        empty = end == first + 1
+        previous = self.marks.get((device, partition))
+        if previous is None or previous[0] > end:
+            return value, (end, empty, _hash(value, 0, end).digest())
+
+        # Hash up to the previous end, then carry on to the new end for the next mark
+        last_end, last_empty, last_digest = previous
+        hasher = _hash(value, 0, last_end)
+        matches = hasher.digest() == last_digest
+        mark = (end, empty, _hash(value, last_end, end, hasher).digest())
+        if not matches:
+            return value, mark
+        if last_end == end:
+            return '[]', mark
+
+        # After non empty content the appended records must start with a separator
+        rest = value[last_end:end].lstrip(_WHITESPACE)
+        if not last_empty:
+            if not rest.startswith(','):
+                return value, mark
+            rest = rest[1:].lstrip(_WHITESPACE)
+        return '[' + rest + ']', mark
+
+def _hash(value, start, end, hasher=None):
+    """
+    Hash part of a string a chunk at a time, so the string is never copied in full
+    """
+    if hasher is None:
+        hasher = hashlib.blake2b(digest_size=16)
+    for offset in range(start, end, _DIGEST_CHUNK):
+        hasher.update(value[offset:min(offset + _DIGEST_CHUNK, end)].encode('utf-8'))
+    return hasher
+
+def _skip_whitespace(value, index, step):
+    while 0 <= index < len(value) and value[index] in _WHITESPACE:
+        index += step
+    return index
+
+def _get_filter(config):
+    name = config['filter']
+    if name not in _filters:
+        print('Using filter module:', name)
+        _filters[name] = _FilterStage(importlib.import_module(name), config)
+    return _filters[name]
+
 def _load_config(config_path):
     if config_path.endswith('.json'):
         return json.load(open(config_path))
@@ -63,9 +191,7 @@ def _run_analysis(device, config=None, data=None):
         device_data = data_store.retrieve(device)
     if 'filter' in analytics_config:
         with CodeTimer('filter data', silent=silent):
-            print('Using filter module:', analytics_config['filter'])
-            filter = importlib.import_module(analytics_config['filter'])
-            device_data = filter.filter(analytics_config, device_data)
+            device_data = _get_filter(analytics_config).apply(analytics_config, device, device_data)
     with CodeTimer('process data', silent=silent):
         result = analytics.process(device_data)
     with CodeTimer('store data', silent=silent):
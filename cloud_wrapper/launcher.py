@@ -1,28 +1,215 @@
-
 """
 Main Cloud Wrapper command line launcher
 """
 from cloud_wrapper.analyse import analyse
 import json
 import os
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+USAGE = ('usage: process.py [--shard <i>/<n> [--report <file>] | --workers <n>] '
+    '<device-id>[,<device-id>...] | @ [optional-sample-data-file] | [optional-sample-data-folder]')
 
 # Call analytics method
 def launch(argv):
-    if len(argv) > 2:
-        path = argv[2]
+    try:
+        options, args = _parse_options(argv[1:])
+        if len(args) == 0:
+            print(USAGE)
+            return 1
+        if 'workers' in options:
+            return coordinate(options['workers'], args)
+        jobs = _jobs(args)
+    except ValueError as err:
+        print('ERROR:', err)
+        print(USAGE)
+        return 1
+
+    shard = options.get('shard')
+    if shard is not None:
+        jobs = [job for job in jobs if shard_for(job[0], shard[1]) == shard[0]]
+    report = _run_jobs(jobs, shard, options.get('report'))
+    if report['failed']:
+        print('ERROR:', len(report['failed']), 'of', report['samples'], 'samples failed')
+        return 1
+    return 0
+
+def shard_for(device, shards):
+    """
+    Stable shard assignment for a device. All samples for a device land on the same shard,
+    whichever node or process computes it.
+    """
+    return zlib.crc32(device.encode('utf-8')) % shards
+
+def coordinate(workers, args):
+    """
+    Run a sharded job locally by spawning a worker process per shard,
+    then merge the progress and timing reports of the workers.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        processes = []
+        try:
+            for index in range(workers):
+                report = os.path.join(folder, 'shard-' + str(index) + '.json')
+                command = [sys.executable, '-m', 'cloud_wrapper',
+                    '--shard', str(index) + '/' + str(workers), '--report', report] + args
+                processes.append((index, report, subprocess.Popen(command)))
+
+            # Workers keep their report up to date, so a worker that dies still has its progress merged
+            reports = []
+            failed = []
+            for index, report, process in processes:
+                process.wait()
+                if os.path.exists(report):
+                    with open(report) as file:
+                        reports.append(json.load(file))
+                if not os.path.exists(report) or not reports[-1]['complete']:
+                    failed.append(index)
+        finally:
+            for index, report, process in processes:
+                if process.poll() is None:
+                    process.terminate()
+                    process.wait()
+
+    merged = _merge_reports(reports)
+    print('Processed', merged['samples'], 'samples for', merged['devices'], 'devices in',
+        workers, 'shards, slowest shard took', '%.3f' % merged['elapsed'], 's')
+    for report in reports:
+        print('  shard', report['shard'] + ':', report['samples'], 'of', report['total'], 'samples,',
+            report['devices'], 'devices,', len(report['failed']), 'failed,', '%.3f' % report['elapsed'], 's')
+    for device, sample in merged['failed']:
+        print('ERROR: failed', device, sample or 'local data')
+    if failed:
+        print('ERROR: shards failed:', ', '.join(str(index) + '/' + str(workers) for index in failed))
+    if failed or merged['failed']:
+        return 1
+    return 0
+
+def _parse_options(args):
+    options = {}
+    while len(args) > 0 and args[0].startswith('--'):
+        if len(args) < 2:
+            raise ValueError('missing value for ' + args[0])
+        name, value = args[0][2:], args[1]
+        if name == 'shard':
+            index, _, shards = value.partition('/')
+            if not index.isdigit() or not shards.isdigit() or int(index) >= int(shards):
+                raise ValueError('shard must be <i>/<n> with 0 <= i < n, got ' + value)
+            options['shard'] = (int(index), int(shards))
+        elif name == 'workers':
+            if not value.isdigit() or int(value) < 1:
+                raise ValueError('workers must be a positive number, got ' + value)
+            options['workers'] = int(value)
+        elif name == 'report':
+            options['report'] = value
+        else:
+            raise ValueError('unknown option ' + args[0])
+        args = args[2:]
+    if 'workers' in options and ('shard' in options or 'report' in options):
+        raise ValueError('--workers cannot be combined with --shard or --report')
+    return options, args
+
+def _jobs(args):
+    """
+    List the (device, sample file) pairs to process. The sample file is None when data
+    is loaded from the local data store. A device id of '@' uses the name of the top level
+    folder holding each sample, e.g. samples/<device-id>/[...]/<sample>.json, and skips
+    samples directly in the samples folder. For a single sample file its folder name is used.
+    """
+    devices = args[0].split(',')
+    if len(args) > 1:
+        path = args[1]
         if os.path.isdir(path):
+            samples = []
             for (folder, foldernames, filenames) in os.walk(path):
                 for filename in filenames:
-                    filepath = folder + '/' + filename
-                    with open(filepath) as file:
-                        print('Loading sample data from', filepath)
-                        analyse(argv[1], data={ 'sample': file.read() })
+                    samples.append(folder + '/' + filename)
         else:
-            with open(path) as file:
-                print('Loading sample data from', path)
-                analyse(argv[1], data={ 'sample': file.read() })
-    elif len(argv) > 1:
-        print('Loading data from local data store', argv[1])
-        analyse(argv[1])
+            samples = [path]
     else:
-        print('usage: process.py <device-id> [optional-sample-data-file] | [optional-sample-data-folder]')
+        if devices == ['@']:
+            raise ValueError('a sample file or folder is needed to use @ as the device id')
+        return [(device, None) for device in devices]
+
+    jobs = []
+    for sample in samples:
+        if devices != ['@']:
+            jobs.extend((device, sample) for device in devices)
+        elif sample == path:
+            jobs.append((os.path.basename(os.path.dirname(os.path.abspath(sample))), sample))
+        else:
+            parts = os.path.relpath(sample, path).split(os.sep)
+            if len(parts) == 1:
+                print('WARNING: skipping', sample, '- samples must be in a folder named after the device')
+                continue
+            jobs.append((parts[0], sample))
+    return jobs
+
+def _run_jobs(jobs, shard=None, report_path=None):
+    """
+    Process the jobs, carrying on past failures so progress for the other devices is kept.
+    Failed jobs are listed in the report as [device, sample] pairs. When a report path is
+    given the report is rewritten after every job, so progress survives a worker that dies.
+    """
+    report = {
+        'shard': '0/1' if shard is None else str(shard[0]) + '/' + str(shard[1]),
+        'devices': 0,
+        'samples': 0,
+        'total': len(jobs),
+        'elapsed': 0,
+        'timings': {},
+        'failed': [],
+        'complete': False
+    }
+    timings = report['timings']
+    start = time.perf_counter()
+    _write_report(report, report_path)
+    for device, sample in jobs:
+        device_start = time.perf_counter()
+        try:
+            if sample is None:
+                print('Loading data from local data store', device)
+                analyse(device)
+            else:
+                with open(sample) as file:
+                    print('Loading sample data from', sample)
+                    analyse(device, data={ 'sample': file.read() })
+        except Exception as err:
+            print('ERROR:', device, '- unable to process', sample or 'local data')
+            print('ERROR:', device, '-', repr(err))
+            report['failed'].append([device, sample])
+        timings[device] = timings.get(device, 0) + time.perf_counter() - device_start
+        report['devices'] = len(timings)
+        report['samples'] += 1
+        report['elapsed'] = time.perf_counter() - start
+        report['complete'] = report['samples'] == report['total']
+        _write_report(report, report_path)
+    report['complete'] = True
+    return report
+
+def _write_report(report, report_path):
+    # Replace the report in one step so a reader never sees a partly written file
+    if report_path is None:
+        return
+    with open(report_path + '.tmp', 'w') as file:
+        json.dump(report, file)
+    os.replace(report_path + '.tmp', report_path)
+
+def _merge_reports(reports):
+    timings = {}
+    failed = []
+    for report in reports:
+        timings.update(report['timings'])
+        failed.extend(report['failed'])
+    return {
+        'devices': len(timings),
+        'samples': sum(report['samples'] for report in reports),
+        'total': sum(report['total'] for report in reports),
+        'elapsed': max([report['elapsed'] for report in reports] or [0]),
+        'timings': timings,
+        'failed': failed,
+        'complete': all(report['complete'] for report in reports)
+    }
@@ -10,6 +10,7 @@ import decimal
 import uuid
 import time
 import types
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from jsonschema import validate, ValidationError
 
@@ -20,6 +21,31 @@ session = boto3.Session()
 s3 = session.client("s3")
 dynamodb = session.resource("dynamodb")
 
+"""
+S3 transfer constants. S3 rejects multipart parts smaller than 5MB (except the last)
+and uploads of more than 10000 parts.
+"""
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+S3_READ_ATTEMPTS = 3
+S3_CHUNK_SIZE = 1024 * 1024
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+def _s3_client(endpoint_url=None):
+    """
+    Get the S3 client for an endpoint. The default client is used unless an endpoint
+    is given, e.g. a local S3 stand-in such as MinIO or moto_server.
+    """
+    if endpoint_url is None:
+        return s3
+    # Stores are created in worker threads and boto3 sessions are not thread safe
+    with _s3_clients_lock:
+        if endpoint_url not in _s3_clients:
+            _s3_clients[endpoint_url] = session.client("s3", endpoint_url=endpoint_url)
+        return _s3_clients[endpoint_url]
+
 class DataStoreException(Exception):
     """
     Exception class
@@ -241,18 +267,113 @@ class _FileDataStore:
 
 class _S3DataStore:
     """
-    Data store using an S3 bucket
+    Data store using an S3 bucket.
+    Objects larger than the multipart threshold are read with concurrent ranged GETs
+    into a preallocated buffer and written with a parallel multipart upload.
     """
+    multipart_threshold = 64 * 1024 * 1024
+    part_size = 16 * 1024 * 1024
+    max_concurrency = 8
+
+    def _configure_s3(self, params):
+        self.multipart_threshold = max(int(params.get('multipart_threshold', self.multipart_threshold)), 1)
+        self.part_size = max(int(params.get('part_size', self.part_size)), S3_MIN_PART_SIZE)
+        self.max_concurrency = max(int(params.get('max_concurrency', self.max_concurrency)), 1)
+        self.client = _s3_client(params.get('endpoint_url'))
+
     def read(self) -> str:
-        s3_obj = s3.get_object(Bucket=self.bucketname, Key=self.path)
-        return s3_obj['Body'].read().decode('utf-8').strip()
+        for attempt in range(S3_READ_ATTEMPTS):
+            try:
+                return self._read()
+            except botocore.exceptions.ClientError as err:
+                if err.response.get('Error', {}).get('Code') != 'PreconditionFailed':
+                    raise err
+        raise DataStoreException("s3://" + self.bucketname + "/" + self.path +
+            " changed while being read " + str(S3_READ_ATTEMPTS) + " times")
+
+    def _read(self) -> str:
+        # The first part tells us the total size, objects no larger than a part take a single request
+        try:
+            s3_obj = self.client.get_object(Bucket=self.bucketname, Key=self.path,
+                Range='bytes=0-' + str(self.part_size - 1))
+        except botocore.exceptions.ClientError as err:
+            if err.response.get('Error', {}).get('Code') == 'InvalidRange':
+                return ''
+            raise err
+        if 'ContentRange' in s3_obj:
+            size = int(s3_obj['ContentRange'].split('/')[-1])
+        else:
+            size = s3_obj['ContentLength']
+        if size <= self.part_size:
+            return s3_obj['Body'].read().decode('utf-8').strip()
+
+        # Objects up to the threshold fetch the rest in one range, larger ones in parallel parts.
+        # Later ranges must come from the same version of the object as the first one.
+        if size <= self.multipart_threshold:
+            ranges = [(self.part_size, size)]
+        else:
+            ranges = [(start, min(start + self.part_size, size))
+                for start in range(self.part_size, size, self.part_size)]
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(ranges) + 1)) as executor:
+            readers = [executor.submit(self._read_body, s3_obj['Body'], view, 0, self.part_size)]
+            readers.extend(executor.submit(self._read_range, view, start, end, s3_obj['ETag']) for start,end in ranges)
+        for reader in readers:
+            reader.result()
+        view.release()
+
+        # Only the buffer and the decoded string are alive at once, strip() copies only if there is whitespace
+        value = buffer.decode('utf-8')
+        del buffer
+        return value.strip()
+
+    def _read_range(self, view, start, end, etag):
+        s3_obj = self.client.get_object(Bucket=self.bucketname, Key=self.path, IfMatch=etag,
+            Range='bytes=' + str(start) + '-' + str(end - 1))
+        self._read_body(s3_obj['Body'], view, start, end)
+
+    def _read_body(self, body, view, start, end):
+        """
+        Copy a streamed body into its slot in the buffer, one chunk at a time
+        """
+        offset = start
+        for chunk in body.iter_chunks(chunk_size=S3_CHUNK_SIZE):
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        if offset != end:
+            raise DataStoreException("Short read from s3://" + self.bucketname + "/" + self.path +
+                " for bytes " + str(start) + "-" + str(end - 1))
 
     def write(self, value):
-        s3.put_object(Bucket=self.bucketname, Key=self.path, Body=value)
+        body = value.encode('utf-8') if isinstance(value, str) else value
+        if len(body) <= self.multipart_threshold:
+            self.client.put_object(Bucket=self.bucketname, Key=self.path, Body=body)
+            return
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucketname, Key=self.path)['UploadId']
+        try:
+            view = memoryview(body)
+            part_size = max(self.part_size, -(-len(body) // S3_MAX_PARTS))
+            starts = range(0, len(body), part_size)
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(starts))) as executor:
+                writers = [executor.submit(self._write_part, upload_id, number, view[start:start + part_size])
+                    for number,start in enumerate(starts, 1)]
+            parts = [writer.result() for writer in writers]
+            self.client.complete_multipart_upload(Bucket=self.bucketname, Key=self.path,
+                UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucketname, Key=self.path, UploadId=upload_id)
+            raise
+
+    def _write_part(self, upload_id, number, part):
+        response = self.client.upload_part(Bucket=self.bucketname, Key=self.path,
+            UploadId=upload_id, PartNumber=number, Body=part.tobytes())
+        return {'ETag': response['ETag'], 'PartNumber': number}
 
     def exists(self) -> bool:
         try:
-            response = s3.head_object(Bucket=self.bucketname, Key=self.path)
+            response = self.client.head_object(Bucket=self.bucketname, Key=self.path)
             return True
         except botocore.exceptions.ClientError:
             return False        
@@ -419,6 +540,7 @@ class SimpleS3DataStore(_UpdatableDataStore, _S3DataStore):
     def __init__(self, params):
         self.bucketname = params['bucket']
         self.path = params['path'] + "/" + params['key'] + "/" + (params['partition'] + ".json")
+        self._configure_s3(params)
 
 
 class SimpleDynamoDataStore(_UpdatableDataStore, _DynamoDataStore):
@@ -474,4 +596,5 @@ class AppendingS3DataStore(_AppendingDataStore,_S3DataStore):
     def __init__(self, params):
         self.bucketname = params['bucket']
         self.path = params['path'] + "/" + params['key'] + "/" + (params['partition'] + ".json")
+        self._configure_s3(params)
 
@@ -0,0 +1,33 @@
+"""
+Sample filter file
+"""
+
+import json
+
+class Filter:
+    """
+    Incremental filter keeping a rolling window of the most recent history records per device.
+    It is created once and only sees the history records added since its previous call, so it
+    never parses the full history. The filter stage still hashes the previous history content on
+    each call to check that records were only appended, which is linear in the history size but
+    much cheaper than parsing it.
+    """
+    incremental = True
+    window = 100
+
+    def __init__(self, config: dict):
+        self.windows = {}
+
+    def filter(self, device: str, device_data: dict, reset: set) -> dict:
+        if device_data.get('history') is None:
+            return device_data
+
+        # The full history is passed on the first call for a device, or if it was rewritten
+        records = json.loads(device_data['history'])
+        if 'history' in reset:
+            self.windows[device] = records[-self.window:]
+        else:
+            self.windows[device] = (self.windows.get(device, []) + records)[-self.window:]
+
+        device_data['history'] = json.dumps(self.windows[device])
+        return device_data
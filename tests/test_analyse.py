@@ -0,0 +1,142 @@
+import json
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from cloud_wrapper import analyse
+
+
+def _history(*records, indent=None, ensure_ascii=True):
+    return json.dumps(list(records), indent=indent, ensure_ascii=ensure_ascii)
+
+
+class RecordingFilter:
+    """
+    Incremental filter remembering every call it receives
+    """
+    incremental = True
+    created = 0
+
+    def __init__(self, config):
+        RecordingFilter.created += 1
+        self.calls = []
+        self.fail = False
+
+    def filter(self, device, device_data, reset):
+        if self.fail:
+            raise RuntimeError('filter failed')
+        self.calls.append((device, dict(device_data), set(reset)))
+        return device_data
+
+
+class TestFilterStage(unittest.TestCase):
+
+    def _module(self, name, **attrs):
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+        self.addCleanup(sys.modules.pop, name)
+        self.addCleanup(analyse._filters.pop, name, None)
+        return module
+
+    def _incremental(self):
+        stage = analyse._FilterStage(self._module('cw_test_incremental_filter', Filter=RecordingFilter), {})
+        return stage, stage.instance
+
+    def test_function_filter_gets_current_config(self):
+        seen = []
+        def filter(config, device_data):
+            seen.append(config['window'])
+            return {'sample': device_data['sample'].upper()}
+        self._module('cw_test_function_filter', filter=filter)
+
+        for window in (1, 2):
+            config = {'filter': 'cw_test_function_filter', 'window': window}
+            result = analyse._get_filter(config).apply(config, 'dev1', {'sample': 'abc'})
+            self.assertEqual(result, {'sample': 'ABC'})
+        self.assertEqual(seen, [1, 2])
+
+    def test_filter_class_created_once(self):
+        RecordingFilter.created = 0
+        self._module('cw_test_class_filter', Filter=RecordingFilter)
+        config = {'filter': 'cw_test_class_filter'}
+        for sample in ('{"a": 1}', '{"a": 2}'):
+            analyse._get_filter(config).apply(config, 'dev1', {'sample': sample})
+        self.assertEqual(RecordingFilter.created, 1)
+        self.assertEqual(len(analyse._get_filter(config).instance.calls), 2)
+
+    def test_incremental_slices_appended_records(self):
+        stage, instance = self._incremental()
+        stage.apply({}, 'dev1', {'history': _history({'s': 1})})
+        stage.apply({}, 'dev1', {'history': _history({'s': 1}, {'s': 2}, {'s': 3})})
+        stage.apply({}, 'dev1', {'history': _history({'s': 1}, {'s': 2}, {'s': 3})})
+
+        self.assertEqual(instance.calls[0][2], {'history'})
+        self.assertEqual(json.loads(instance.calls[1][1]['history']), [{'s': 2}, {'s': 3}])
+        self.assertEqual(instance.calls[1][2], set())
+        self.assertEqual(json.loads(instance.calls[2][1]['history']), [])
+
+    def test_incremental_after_empty_and_indented(self):
+        stage, instance = self._incremental()
+        stage.apply({}, 'dev1', {'history': _history(indent=4)})
+        stage.apply({}, 'dev1', {'history': _history({'s': 1}, indent=4)})
+        stage.apply({}, 'dev1', {'history': _history({'s': 1}, {'s': 2}, indent=4)})
+
+        self.assertEqual(json.loads(instance.calls[1][1]['history']), [{'s': 1}])
+        self.assertEqual(json.loads(instance.calls[2][1]['history']), [{'s': 2}])
+        self.assertEqual(instance.calls[2][2], set())
+
+    def test_digest_is_chunked_by_characters(self):
+        stage, instance = self._incremental()
+        with mock.patch.object(analyse, '_DIGEST_CHUNK', 3):
+            stage.apply({}, 'dev1', {'history': _history('Grüße', 'ü', ensure_ascii=False)})
+            stage.apply({}, 'dev1', {'history': _history('Grüße', 'ü', 'é', ensure_ascii=False)})
+            stage.apply({}, 'dev1', {'history': _history('Grüße', 'ö', 'é', 'x', ensure_ascii=False)})
+        self.assertEqual(json.loads(instance.calls[1][1]['history']), ['é'])
+        self.assertEqual(instance.calls[2][2], {'history'})
+
+    def test_incremental_state_is_per_device(self):
+        stage, instance = self._incremental()
+        stage.apply({}, 'dev1', {'history': _history({'s': 1})})
+        stage.apply({}, 'dev2', {'history': _history({'s': 1}, {'s': 2})})
+        self.assertEqual(instance.calls[1][2], {'history'})
+
+    def test_rewritten_collection_is_reset(self):
+        stage, instance = self._incremental()
+        old = _history(*[{'s': 1}] * 20)
+        new = _history(*([{'s': 1}] * 15 + [{'s': 9}] * 10))
+        stage.apply({}, 'dev1', {'history': old})
+        stage.apply({}, 'dev1', {'history': new})
+        self.assertEqual(instance.calls[1][1]['history'], new)
+        self.assertEqual(instance.calls[1][2], {'history'})
+
+    def test_changed_last_record_is_reset(self):
+        stage, instance = self._incremental()
+        stage.apply({}, 'dev1', {'history': '[1, 2]'})
+        stage.apply({}, 'dev1', {'history': '[1, 23]'})
+        self.assertEqual(instance.calls[1][1]['history'], '[1, 23]')
+        self.assertEqual(instance.calls[1][2], {'history'})
+
+    def test_non_collections_are_reset(self):
+        stage, instance = self._incremental()
+        for sample in ('{"a": 1}', '{"a": 1}'):
+            stage.apply({}, 'dev1', {'sample': sample, 'model': None, 'history': '[]'})
+        self.assertEqual(instance.calls[1][2], {'sample', 'model'})
+
+    def test_failed_filter_does_not_consume_records(self):
+        stage, instance = self._incremental()
+        stage.apply({}, 'dev1', {'history': _history({'s': 1})})
+        instance.fail = True
+        with self.assertRaises(RuntimeError):
+            stage.apply({}, 'dev1', {'history': _history({'s': 1}, {'s': 2})})
+        instance.fail = False
+        stage.apply({}, 'dev1', {'history': _history({'s': 1}, {'s': 2}, {'s': 3})})
+        self.assertEqual(json.loads(instance.calls[1][1]['history']), [{'s': 2}, {'s': 3}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import json
+import os
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from cloud_wrapper import launcher
+
+
+class TestOptions(unittest.TestCase):
+
+    def test_shard_and_report(self):
+        options, args = launcher._parse_options(['--shard', '1/4', '--report', 'r.json', 'dev1', 'samples'])
+        self.assertEqual(options, {'shard': (1, 4), 'report': 'r.json'})
+        self.assertEqual(args, ['dev1', 'samples'])
+
+    def test_workers(self):
+        options, args = launcher._parse_options(['--workers', '3', '@', 'samples'])
+        self.assertEqual(options, {'workers': 3})
+        self.assertEqual(args, ['@', 'samples'])
+
+    def test_no_options(self):
+        self.assertEqual(launcher._parse_options(['dev1']), ({}, ['dev1']))
+
+    def test_invalid(self):
+        for args in (['--shard', '4/4', 'dev1'], ['--shard', 'x/4', 'dev1'], ['--workers', '0', 'dev1'],
+                ['--workers', '2', '--shard', '0/2', 'dev1'], ['--unknown', 'x', 'dev1'], ['--shard']):
+            with self.assertRaises(ValueError):
+                launcher._parse_options(args)
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        for device in ('dev1', 'dev2'):
+            os.mkdir(os.path.join(self.folder.name, device))
+            for sample in ('a.json', 'b.json'):
+                with open(os.path.join(self.folder.name, device, sample), 'w') as file:
+                    file.write('{}')
+
+    def test_local_data_for_device_list(self):
+        self.assertEqual(launcher._jobs(['dev1,dev2']), [('dev1', None), ('dev2', None)])
+
+    def test_sample_file_for_device_list(self):
+        sample = os.path.join(self.folder.name, 'dev1', 'a.json')
+        self.assertEqual(launcher._jobs(['x,y', sample]), [('x', sample), ('y', sample)])
+
+    def test_device_from_folder(self):
+        jobs = sorted(launcher._jobs(['@', self.folder.name]))
+        self.assertEqual([device for device, sample in jobs], ['dev1', 'dev1', 'dev2', 'dev2'])
+        self.assertTrue(all(os.path.basename(os.path.dirname(sample)) == device for device, sample in jobs))
+
+    def test_device_from_top_level_folder(self):
+        nested = os.path.join(self.folder.name, 'dev1', '2024')
+        os.mkdir(nested)
+        with open(os.path.join(nested, 'c.json'), 'w') as file:
+            file.write('{}')
+        jobs = launcher._jobs(['@', self.folder.name])
+        self.assertIn(('dev1', os.path.join(nested, 'c.json')), jobs)
+        self.assertEqual(sorted(set(device for device, sample in jobs)), ['dev1', 'dev2'])
+
+    def test_device_from_folder_skips_top_level_samples(self):
+        with open(os.path.join(self.folder.name, 'top.json'), 'w') as file:
+            file.write('{}')
+        jobs = launcher._jobs(['@', self.folder.name])
+        self.assertEqual(len(jobs), 4)
+        self.assertNotIn(os.path.basename(self.folder.name), [device for device, sample in jobs])
+
+    def test_device_from_folder_of_sample_file(self):
+        sample = os.path.join(self.folder.name, 'dev2', 'a.json')
+        self.assertEqual(launcher._jobs(['@', sample]), [('dev2', sample)])
+
+    def test_device_from_folder_needs_samples(self):
+        with self.assertRaises(ValueError):
+            launcher._jobs(['@'])
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_stable(self):
+        self.assertEqual(launcher.shard_for('dev1', 7), zlib.crc32(b'dev1') % 7)
+        self.assertEqual(launcher.shard_for('motor-42', 4), launcher.shard_for('motor-42', 4))
+
+    def test_partitions_devices(self):
+        devices = ['motor-' + str(i) for i in range(200)]
+        shards = [[device for device in devices if launcher.shard_for(device, 4) == index] for index in range(4)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(devices))
+        self.assertTrue(all(len(shard) > 0 for shard in shards))
+
+
+class TestReports(unittest.TestCase):
+
+    def test_failures_are_recorded(self):
+        def analyse(device, data=None):
+            if device == 'bad':
+                raise RuntimeError('broken')
+
+        with mock.patch.object(launcher, 'analyse', analyse):
+            report = launcher._run_jobs([('good', None), ('bad', None), ('good', None)], (1, 3))
+        self.assertEqual(report['shard'], '1/3')
+        self.assertEqual(report['samples'], 3)
+        self.assertEqual(report['devices'], 2)
+        self.assertEqual(report['failed'], [['bad', None]])
+        self.assertTrue(report['complete'])
+
+    def test_report_is_written_as_jobs_complete(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, 'report.json')
+        seen = []
+
+        def analyse(device, data=None):
+            with open(path) as file:
+                seen.append(json.load(file))
+
+        with mock.patch.object(launcher, 'analyse', analyse):
+            launcher._run_jobs([('dev1', None), ('dev2', None)], (0, 1), path)
+        self.assertEqual([(report['samples'], report['complete']) for report in seen], [(0, False), (1, False)])
+        self.assertEqual(list(seen[1]['timings']), ['dev1'])
+        with open(path) as file:
+            final = json.load(file)
+        self.assertEqual((final['samples'], final['total'], final['complete']), (2, 2, True))
+
+    def test_merge(self):
+        reports = [
+            {'shard': '0/2', 'devices': 1, 'samples': 2, 'elapsed': 1.5,
+                'timings': {'dev1': 1.5}, 'failed': [], 'total': 2, 'complete': True},
+            {'shard': '1/2', 'devices': 2, 'samples': 3, 'elapsed': 2.5,
+                'timings': {'dev2': 1.0, 'dev3': 1.5}, 'failed': [['dev3', 's.json']], 'total': 4, 'complete': False}
+        ]
+        merged = launcher._merge_reports(reports)
+        self.assertEqual(merged['devices'], 3)
+        self.assertEqual(merged['samples'], 5)
+        self.assertEqual(merged['elapsed'], 2.5)
+        self.assertEqual(merged['failed'], [['dev3', 's.json']])
+        self.assertEqual(merged['total'], 6)
+        self.assertFalse(merged['complete'])
+
+    def test_merge_nothing(self):
+        self.assertEqual(launcher._merge_reports([])['elapsed'], 0)
+
+
+class TestCoordinator(unittest.TestCase):
+
+    def test_workers_are_terminated_on_interrupt(self):
+        processes = [mock.Mock(), mock.Mock()]
+        processes[0].wait.side_effect = [KeyboardInterrupt(), 0]
+        processes[1].poll.return_value = None
+        processes[0].poll.return_value = None
+        with mock.patch.object(launcher.subprocess, 'Popen', side_effect=processes):
+            with self.assertRaises(KeyboardInterrupt):
+                launcher.coordinate(2, ['dev1'])
+        for process in processes:
+            process.terminate.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
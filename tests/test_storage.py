@@ -0,0 +1,180 @@
+import io
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import botocore
+from botocore.response import StreamingBody
+from cloud_wrapper import storage
+
+ENDPOINT = 'http://local-s3'
+
+
+def _client_error(code, operation):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}}, operation)
+
+
+class LocalS3:
+    """
+    In memory S3 stand-in, registered as the client for a local endpoint
+    """
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+        self.uploads = {}
+        self.aborted = []
+        self.short = False
+        self.fail_part = None
+        self.overwrite_after_first_get = None
+
+    def _put(self, key, data):
+        version = len(self.calls)
+        self.objects[key] = (bytes(data), '"etag-' + str(version) + '"')
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self.calls.append(('get_object', Range, IfMatch))
+        data, etag = self.objects[Key]
+        if IfMatch is not None and IfMatch != etag:
+            raise _client_error('PreconditionFailed', 'GetObject')
+        response = {'ETag': etag}
+        if Range is not None:
+            first, last = [int(x) for x in Range[len('bytes='):].split('-')]
+            if first >= len(data):
+                raise _client_error('InvalidRange', 'GetObject')
+            last = min(last, len(data) - 1)
+            response['ContentRange'] = 'bytes ' + str(first) + '-' + str(last) + '/' + str(len(data))
+            data = data[first:last + 1]
+            if self.short and first > 0:
+                data = data[:-1]
+        response['ContentLength'] = len(data)
+        response['Body'] = StreamingBody(io.BytesIO(data), len(data))
+        if self.overwrite_after_first_get is not None:
+            self._put(Key, self.overwrite_after_first_get)
+            self.overwrite_after_first_get = None
+        return response
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append(('put_object',))
+        self._put(Key, Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append(('create_multipart_upload',))
+        self.uploads['upload-1'] = {}
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise _client_error('InternalError', 'UploadPart')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"part-' + str(PartNumber) + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = MultipartUpload['Parts']
+        assert [part['PartNumber'] for part in parts] == list(range(1, len(parts) + 1))
+        uploaded = self.uploads.pop(UploadId)
+        self.completed_parts = len(parts)
+        self._put(Key, b''.join(uploaded[part['PartNumber']] for part in parts))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+        del self.uploads[UploadId]
+
+
+class TestS3DataStore(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = LocalS3()
+        storage._s3_clients[ENDPOINT] = self.s3
+        # Allow tiny parts so multipart behaviour can be checked on small objects
+        patcher = mock.patch.object(storage, 'S3_MIN_PART_SIZE', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(storage._s3_clients.pop, ENDPOINT)
+
+    def _store(self, **params):
+        params = dict({'bucket': 'bucket', 'path': 'db', 'key': 'dev1', 'partition': 'history',
+            'endpoint_url': ENDPOINT}, **params)
+        return storage.SimpleS3DataStore(params)
+
+    def _ranges(self):
+        return [call[1] for call in self.s3.calls if call[0] == 'get_object']
+
+    def test_read_of_one_part_is_single_get(self):
+        self.s3.objects['db/dev1/history.json'] = (b' {"a": 1}\n', '"v1"')
+        self.assertEqual(self._store(part_size=100).read(), '{"a": 1}')
+        self.assertEqual(self._ranges(), ['bytes=0-99'])
+
+    def test_read_below_threshold_fetches_rest_in_one_range(self):
+        value = 'x' * 100
+        self.s3.objects['db/dev1/history.json'] = (value.encode('utf-8'), '"v1"')
+        self.assertEqual(self._store(multipart_threshold=100, part_size=30).read(), value)
+        self.assertEqual(self._ranges(), ['bytes=0-29', 'bytes=30-99'])
+
+    def test_read_above_threshold_reassembles_ranges(self):
+        value = '[' + ', '.join('{"s": ' + str(i) + '}' for i in range(50)) + ']'
+        self.s3.objects['db/dev1/history.json'] = (value.encode('utf-8'), '"v1"')
+        store = self._store(multipart_threshold=64, part_size=32, max_concurrency=4)
+        self.assertEqual(store.read(), value)
+        ranges = self._ranges()
+        self.assertEqual(len(ranges), -(-len(value) // 32))
+        self.assertTrue(all(call[2] == '"v1"' for call in self.s3.calls[1:]))
+
+    def test_threshold_is_the_same_for_reads_and_writes(self):
+        store = self._store(multipart_threshold=100, part_size=30)
+        store.write('x' * 100)
+        self.assertEqual(self.s3.calls, [('put_object',)])
+
+    def test_client_is_created_once_per_endpoint(self):
+        with mock.patch.object(storage.session, 'client') as client:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                clients = list(executor.map(storage._s3_client, ['http://other-s3'] * 32))
+        self.addCleanup(storage._s3_clients.pop, 'http://other-s3')
+        client.assert_called_once_with('s3', endpoint_url='http://other-s3')
+        self.assertTrue(all(c is clients[0] for c in clients))
+
+    def test_read_empty_object(self):
+        self.s3.objects['db/dev1/history.json'] = (b'', '"v1"')
+        self.assertEqual(self._store().read(), '')
+
+    def test_short_read_raises(self):
+        self.s3.objects['db/dev1/history.json'] = (b'x' * 100, '"v1"')
+        self.s3.short = True
+        with self.assertRaises(storage.DataStoreException):
+            self._store(multipart_threshold=10, part_size=30).read()
+
+    def test_read_retries_when_object_is_overwritten(self):
+        self.s3.objects['db/dev1/history.json'] = (b'a' * 100, '"v1"')
+        self.s3.overwrite_after_first_get = b'b' * 100
+        self.assertEqual(self._store(multipart_threshold=10, part_size=30).read(), 'b' * 100)
+
+    def test_threshold_is_clamped(self):
+        store = self._store(multipart_threshold=0)
+        self.assertEqual(store.multipart_threshold, 1)
+        store.write('')
+        self.assertEqual(self.s3.objects['db/dev1/history.json'][0], b'')
+
+    def test_write_below_threshold_is_single_put(self):
+        self._store(multipart_threshold=100).write('{"a": 1}')
+        self.assertEqual(self.s3.calls, [('put_object',)])
+        self.assertEqual(self.s3.objects['db/dev1/history.json'][0], b'{"a": 1}')
+
+    def test_multipart_write_limits_part_count(self):
+        value = 'x' * 100
+        with mock.patch.object(storage, 'S3_MAX_PARTS', 4):
+            self._store(multipart_threshold=10, part_size=10).write(value)
+        self.assertEqual(self.s3.objects['db/dev1/history.json'][0], value.encode('utf-8'))
+        self.assertEqual(self.s3.completed_parts, 4)
+
+    def test_failed_part_aborts_upload(self):
+        self.s3.fail_part = 2
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self._store(multipart_threshold=10, part_size=10).write('x' * 100)
+        self.assertEqual(self.s3.aborted, ['upload-1'])
+        self.assertNotIn('db/dev1/history.json', self.s3.objects)
+
+
+if __name__ == '__main__':
+    unittest.main()